@@ -1,55 +1,52 @@
 import datetime
 import json
 import logging.config
-import operator
-from dataclasses import dataclass
-from functools import partial
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Optional, Iterable, Literal
+from typing import Callable, Optional, Iterator
 
 import boto3
-from boto3 import Session
+import botocore.config
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from mypy_boto3_s3 import S3Client
-from mypy_boto3_s3.type_defs import ListObjectsV2OutputTypeDef
+from mypy_boto3_s3.paginator import ListObjectsV2Paginator
+from s3transfer.futures import TransferFuture
+from s3transfer.manager import TransferManager
 
 _PATH_CONFIG: Path = Path('.') / 'config.json'
 _APP_LOGGER_ROOT_NAME: str = "backuper_to_s3"
+_LOCAL_TIMESTAMP_CACHE_NAME: str = '.backup_cache.json'
+_LIST_OBJECTS_PAGE_SIZE: int = 1000
+_FAST_TIMESTAMP_DIRECTIVES: dict[str, str] = {
+	'Y': r'(?P<Y>\d{4})',
+	'm': r'(?P<m>\d{2})',
+	'd': r'(?P<d>\d{2})',
+	'H': r'(?P<H>\d{2})',
+	'M': r'(?P<M>\d{2})',
+	'S': r'(?P<S>\d{2})',
+}
+_S3_CLIENT_CONFIG: botocore.config.Config = botocore.config.Config(
+	max_pool_connections=32,
+	tcp_keepalive=True,
+	retries={'max_attempts': 10, 'mode': 'adaptive'}
+)
+_ISO_TIMESTAMP_FORMAT: re.Pattern[str] = re.compile(r'%Y-%m-%d([^%])%H:%M:%S')
+_TRANSFER_CONFIG: TransferConfig = TransferConfig(
+	multipart_threshold=8 * 1024 * 1024,
+	multipart_chunksize=8 * 1024 * 1024,
+	max_concurrency=10,
+	use_threads=True
+)
 
-logging.config.dictConfig({
-	'version': 1,
-	'formatters': {
-		'complete_formatter': {
-			'format': '[$levelname]\t[$asctime]\t[$pathname]\t$message',
-			'style': '$',
-			'datefmt': '%Y-%m-%d %H:%M:%S%z'
-		},
-		'simple_formatter': {
-
-		}
-	},
-	'handlers': {
-		'console': {
-			'class': 'logging.StreamHandler',
-			'level': 'DEBUG',
-			'formatter': 'complete_formatter',
-			'stream': 'ext://sys.stdout'
-		}
-	},
-	'loggers': {
-		_APP_LOGGER_ROOT_NAME: {
-			'handlers': ['console'],
-			'level': 'DEBUG',
-		}
-	},
-	'root': {
-		'level': 'DEBUG'
-	},
-	'disable_existing_loggers': False,
-})
 logger = logging.getLogger(".".join([_APP_LOGGER_ROOT_NAME, __name__]))
 
+TimestampParser = Callable[[str], Optional[datetime.datetime]]
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class Config:
 	aws_access_key_id: str
 	aws_secret_access_key: str
@@ -60,21 +57,29 @@ class Config:
 	backup_ttl_seconds: int
 	remote_timestamp_format: str
 	local_timestamp_format: str
+	remote_timestamp_parser: Optional[TimestampParser] = field(init=False, repr=False, compare=False)
+	local_timestamp_parser: Optional[TimestampParser] = field(init=False, repr=False, compare=False)
+
+	def __post_init__(self) -> None:
+		object.__setattr__(self, 'remote_timestamp_parser', compile_timestamp_parser(self.remote_timestamp_format))
+		object.__setattr__(self, 'local_timestamp_parser', compile_timestamp_parser(self.local_timestamp_format))
 
 	@classmethod
 	def from_config(cls) -> 'Config':
-		with open(_PATH_CONFIG, encoding='utf8', mode='r') as f:
-			return cls(**json.load(f))
+		return cls(**json.loads(_PATH_CONFIG.read_bytes()))
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TimestampedLocalBackup:
 	timestamp: datetime.datetime
 	path: Path
 
 	@classmethod
 	def maybe_parse(cls, cfg: Config, path: Path) -> Optional['TimestampedLocalBackup']:
-		if (timestamp := path_to_datetime(cfg, 'local', path)) is not None:
+		timestamp: datetime.datetime | None = key_to_datetime(
+			cfg.local_timestamp_format, cfg.local_timestamp_parser, path.name
+		)
+		if timestamp is not None:
 			return cls(timestamp=timestamp, path=path)
 		return None
 
@@ -84,87 +89,260 @@ class TimestampedLocalBackup:
 		return f"{cfg.backup_dir_key_prefix}{formatted_timestamp}.zip"
 
 
-def session_from_config(cfg: Config) -> boto3.session.Session:
-	return boto3.session.Session(
+_client_cache: dict[tuple[str, str], S3Client] = {}
+
+
+def get_client(cfg: Config) -> S3Client:
+	cache_key: tuple[str, str] = (cfg.aws_access_key_id, cfg.region_name)
+	if (client := _client_cache.get(cache_key)) is not None:
+		return client
+
+	session: boto3.session.Session = boto3.session.Session(
 		aws_access_key_id=cfg.aws_access_key_id,
 		aws_secret_access_key=cfg.aws_secret_access_key,
 		region_name=cfg.region_name
 	)
+	client = session.client('s3', config=_S3_CLIENT_CONFIG)
+	_client_cache[cache_key] = client
+	return client
 
 
-def backups_in_s3(client: S3Client, cfg: Config) -> set[datetime.datetime]:
-	response: ListObjectsV2OutputTypeDef = client.list_objects_v2(Bucket=cfg.bucket, Prefix=cfg.backup_dir_key_prefix)
-	stored_keys: Iterable[Path] = (Path(o["Key"]) for o in response["Contents"])
+def backups_in_s3(client: S3Client, cfg: Config) -> tuple[set[datetime.datetime], set[str]]:
+	paginator: ListObjectsV2Paginator = client.get_paginator('list_objects_v2')
+	pages = paginator.paginate(
+		Bucket=cfg.bucket,
+		Prefix=cfg.backup_dir_key_prefix,
+		PaginationConfig={'PageSize': _LIST_OBJECTS_PAGE_SIZE}
+	)
+	# Only .zip keys can be backups, anything else would just fail to parse
+	stored_keys: set[str] = {
+		o["Key"] for page in pages for o in page.get("Contents", ()) if o["Key"].lower().endswith('.zip')
+	}
+
+	timestamp_format: str = cfg.remote_timestamp_format
+	timestamp_parser: Optional[TimestampParser] = cfg.remote_timestamp_parser
+	return {
+		timestamp for key in stored_keys
+		if (timestamp := key_to_datetime(timestamp_format, timestamp_parser, key)) is not None
+	}, stored_keys
+
 
-	return set(filter(
-		partial(operator.is_not, None),
-		map(partial(path_to_datetime, cfg, 'remote'), stored_keys)
-	))
+def local_backup_paths(cfg: Config) -> Iterator[Path]:
+	with os.scandir(cfg.path_local_backups) as entries:
+		yield from (Path(e.path) for e in entries if e.is_file() and e.name.lower().endswith('.zip'))
 
 
-def backups_local(cfg: Config) -> list[TimestampedLocalBackup]:
-	backups_path: Path = Path(cfg.path_local_backups)
-	local_paths: Iterable[Path] = (p for p in backups_path.iterdir() if p.is_file() and p.suffix.lower() == '.zip')
-	return list(filter(
-		partial(operator.is_not, None),
-		map(partial(TimestampedLocalBackup.maybe_parse, cfg), local_paths)
-	))
+def uploaded_by_key(cfg: Config, remote_keys: set[str], local_path: Path) -> bool:
+	# A local name maps verbatim to its remote key only if both sides share the same timestamp format
+	return (
+		cfg.local_timestamp_format == cfg.remote_timestamp_format
+		and f"{cfg.backup_dir_key_prefix}{local_path.stem}.zip" in remote_keys
+	)
+
 
+def local_backup_from_path(
+		cfg: Config, path: Path, timestamp_cache: dict[str, datetime.datetime]
+) -> Optional[TimestampedLocalBackup]:
+	if (timestamp := timestamp_cache.get(path.name)) is not None:
+		return TimestampedLocalBackup(timestamp=timestamp, path=path)
+	return TimestampedLocalBackup.maybe_parse(cfg, path)
 
-def path_to_datetime(cfg: Config, timestamp_source: Literal['remote', 'local'], path: Path) -> datetime.datetime | None:
-	timestamp_format: str
-	match timestamp_source:
-		case 'remote':
-			timestamp_format = cfg.remote_timestamp_format
-		case 'local':
-			timestamp_format = cfg.local_timestamp_format
-		case source:
-			raise ValueError(f"Unknown timestamp source: {source}")
 
-	raw_datetime: str = path.with_suffix('').name
+def load_local_timestamp_cache(cfg: Config) -> dict[str, datetime.datetime]:
+	cache_path: Path = Path(cfg.path_local_backups) / _LOCAL_TIMESTAMP_CACHE_NAME
 	try:
-		return datetime.datetime.strptime(raw_datetime, timestamp_format).replace(tzinfo=datetime.UTC)
+		cached: dict = json.loads(cache_path.read_bytes())
+		# Timestamps depend only on the file name and the format, so a format change invalidates everything
+		if cached['local_timestamp_format'] != cfg.local_timestamp_format:
+			return {}
+		timestamps: dict[str, datetime.datetime] = {
+			name: datetime.datetime.fromisoformat(ts) for name, ts in cached['timestamps'].items()
+		}
+		if any(timestamp.tzinfo is None for timestamp in timestamps.values()):
+			raise ValueError("Cached timestamps must be timezone-aware")
+		return timestamps
+	except FileNotFoundError:
+		return {}
+	except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+		logger.warning("Ignoring unreadable local timestamp cache %s: %r", cache_path, e)
+		return {}
+
+
+def save_local_timestamp_cache(cfg: Config, timestamps: dict[str, datetime.datetime]) -> None:
+	cache_path: Path = Path(cfg.path_local_backups) / _LOCAL_TIMESTAMP_CACHE_NAME
+	tmp_path: Path = cache_path.with_name(f"{cache_path.name}.tmp")
+	try:
+		# Write aside and swap in, so an interrupted run never leaves a truncated cache behind
+		with open(tmp_path, encoding='utf8', mode='w') as f:
+			json.dump({
+				'local_timestamp_format': cfg.local_timestamp_format,
+				'timestamps': {name: timestamp.isoformat() for name, timestamp in timestamps.items()},
+			}, f)
+		os.replace(tmp_path, cache_path)
+	except OSError as e:
+		logger.warning("Could not write local timestamp cache %s: %r", cache_path, e)
+		tmp_path.unlink(missing_ok=True)
+
+
+def compile_timestamp_parser(timestamp_format: str) -> Optional[TimestampParser]:
+	if (iso_match := _ISO_TIMESTAMP_FORMAT.fullmatch(timestamp_format)) is not None:
+		return partial(_parse_timestamp_iso, iso_match[1])
+
+	tokens: list[str] = re.split(r'(%.)', timestamp_format)
+	directives: list[str] = [token[1] for token in tokens if token.startswith('%') and len(token) == 2]
+	if (
+		any(d not in _FAST_TIMESTAMP_DIRECTIVES for d in directives)
+		or len(set(directives)) != len(directives)
+		or not {'Y', 'm', 'd'}.issubset(directives)
+	):
+		return None
+
+	return partial(_parse_timestamp_fast, re.compile(''.join(
+		_FAST_TIMESTAMP_DIRECTIVES[token[1]] if token.startswith('%') and len(token) == 2 else re.escape(token)
+		for token in tokens
+	)))
+
+
+def _parse_timestamp_iso(separator: str, raw_datetime: str) -> Optional[datetime.datetime]:
+	# Appending the UTC offset makes fromisoformat build the aware datetime directly, without a replace()
+	aware_raw_datetime: str = raw_datetime + '+00:00'
+	try:
+		timestamp: datetime.datetime = datetime.datetime.fromisoformat(aware_raw_datetime)
 	except ValueError:
 		return None
+	# fromisoformat also accepts offsets, fractions and other separators, which the configured format does not
+	if timestamp.isoformat(separator, timespec='seconds') != aware_raw_datetime:
+		return None
+	return timestamp
+
+
+def _parse_timestamp_fast(pattern: re.Pattern[str], raw_datetime: str) -> Optional[datetime.datetime]:
+	if (match := pattern.fullmatch(raw_datetime)) is None:
+		return None
+	fields: dict[str, str] = match.groupdict()
+	return datetime.datetime(
+		int(fields['Y']), int(fields['m']), int(fields['d']),
+		int(fields.get('H', 0)), int(fields.get('M', 0)), int(fields.get('S', 0)),
+		tzinfo=datetime.UTC
+	)
 
 
-def expired(cfg: Config, current_timestamp: datetime.datetime, local_backup: TimestampedLocalBackup, ) -> bool:
-	return (current_timestamp - local_backup.timestamp).total_seconds() > cfg.backup_ttl_seconds
+@lru_cache(maxsize=4096)
+def _parse_timestamp(raw_datetime: str, timestamp_format: str) -> datetime.datetime:
+	return datetime.datetime.strptime(raw_datetime, timestamp_format).replace(tzinfo=datetime.UTC)
 
 
-def upload_backup(cfg: Config, s3_client: S3Client, local_backup: TimestampedLocalBackup) -> None:
+def key_to_datetime(
+		timestamp_format: str, timestamp_parser: Optional[TimestampParser], key: str
+) -> datetime.datetime | None:
+	name: str = key.rpartition('/')[2]
+	raw_datetime: str = name.rpartition('.')[0] or name
+	try:
+		if timestamp_parser is not None and (timestamp := timestamp_parser(raw_datetime)) is not None:
+			return timestamp
+		return _parse_timestamp(raw_datetime, timestamp_format)
+	except ValueError:
+		return None
+
+
+def upload_backup(cfg: Config, transfer: TransferManager, local_backup: TimestampedLocalBackup) -> TransferFuture:
 	key: str = local_backup.to_remote_key(cfg)
-	logger.info(f"Uploading backup file {local_backup} to S3 bucket {cfg.bucket} under {key}")
-	s3_client.upload_file(Filename=str(local_backup.path), Bucket=cfg.bucket, Key=key)
+	logger.info("Uploading backup file %s to S3 bucket %s under %s", local_backup, cfg.bucket, key)
+	return transfer.upload(str(local_backup.path), cfg.bucket, key)
+
+
+def _configure_logging() -> None:
+	logging.config.dictConfig({
+		'version': 1,
+		'formatters': {
+			'complete_formatter': {
+				'format': '[$levelname]\t[$asctime]\t[$pathname]\t$message',
+				'style': '$',
+				'datefmt': '%Y-%m-%d %H:%M:%S%z'
+			},
+			'simple_formatter': {
+
+			}
+		},
+		'handlers': {
+			'console': {
+				'class': 'logging.StreamHandler',
+				'level': 'DEBUG',
+				'formatter': 'complete_formatter',
+				'stream': 'ext://sys.stdout'
+			}
+		},
+		'loggers': {
+			_APP_LOGGER_ROOT_NAME: {
+				'handlers': ['console'],
+				'level': 'DEBUG',
+			}
+		},
+		'root': {
+			'level': 'DEBUG'
+		},
+		'disable_existing_loggers': False,
+	})
 
 
 def main() -> None:
+	_configure_logging()
 	logger.info("Started")
 	cfg: Config = Config.from_config()
-	session: Session = session_from_config(cfg)
-	s3_client: S3Client = session.client('s3')
+	s3_client: S3Client = get_client(cfg)
 	logger.debug("Connected")
 
-	remote_backups: set[datetime.datetime] = backups_in_s3(s3_client, cfg)
-	logger.debug(f"Found {len(remote_backups)} remote backups: {remote_backups}")
-	local_backups: list[TimestampedLocalBackup] = backups_local(cfg)
-	logger.debug(f"Found {len(local_backups)} local backups: {local_backups}")
+	remote_backups: set[datetime.datetime]
+	remote_keys: set[str]
+	remote_backups, remote_keys = backups_in_s3(s3_client, cfg)
+	logger.debug("Found %d remote backups: %s", len(remote_backups), remote_backups)
 
 	timestamp_now: datetime.datetime = datetime.datetime.now(datetime.UTC)
-
-	must_upload_backups: list[TimestampedLocalBackup] = list(filter(
-		lambda local: local.timestamp not in remote_backups and not expired(cfg, timestamp_now, local),
-		local_backups
-	))
-
-	logger.debug(f"Files to be uploaded ({len(must_upload_backups)}): {must_upload_backups}")
-
-	for must_upload_backup in must_upload_backups:
-		upload_backup(cfg, s3_client, must_upload_backup)
+	expiry_cutoff: datetime.datetime = timestamp_now - datetime.timedelta(seconds=cfg.backup_ttl_seconds)
+
+	timestamp_cache: dict[str, datetime.datetime] = load_local_timestamp_cache(cfg)
+	local_backups: list[TimestampedLocalBackup] = []
+	uploads: list[tuple[TimestampedLocalBackup, TransferFuture]] = []
+	with create_transfer_manager(s3_client, _TRANSFER_CONFIG) as transfer:
+		scanned_files: int = 0
+		skipped_by_key: int = 0
+		# Uploads start while the local directory is still being scanned
+		for path in local_backup_paths(cfg):
+			scanned_files += 1
+			if uploaded_by_key(cfg, remote_keys, path):
+				skipped_by_key += 1
+				continue
+			if (local := local_backup_from_path(cfg, path, timestamp_cache)) is None:
+				continue
+			local_backups.append(local)
+			if local.timestamp not in remote_backups and local.timestamp >= expiry_cutoff:
+				logger.debug("Queueing file to be uploaded: %s", local)
+				uploads.append((local, upload_backup(cfg, transfer, local)))
+
+		logger.debug(
+			"Found %d local backup files, %d not uploaded under the same key",
+			scanned_files, scanned_files - skipped_by_key
+		)
+		logger.debug("Found %d local backups not uploaded under the same key: %s", len(local_backups), local_backups)
+		logger.debug("Files queued for upload: %d", len(uploads))
+		local_timestamps: dict[str, datetime.datetime] = {b.path.name: b.timestamp for b in local_backups}
+		if local_timestamps != timestamp_cache:
+			save_local_timestamp_cache(cfg, local_timestamps)
+
+		failed_uploads: int = 0
+		for local, upload in uploads:
+			try:
+				upload.result()
+			except Exception as e:
+				failed_uploads += 1
+				logger.exception("Failed to upload backup file %s: %r", local, e)
+
+	if failed_uploads:
+		raise RuntimeError(f"{failed_uploads} of {len(uploads)} uploads failed")
 
 
 if __name__ == '__main__':
 	try:
 		main()
 	except Exception as e:
-		logger.exception(f"Exception occurred: {e!r}")
+		logger.exception("Exception occurred: %r", e)